@@ -1,14 +1,24 @@
 import json
 import logging
+import time
 import traceback
 import urllib.parse
-import requests
 
+from . import stats
 from .config import CONFIG
+from .models import Alert, ButtonValue, Interaction, ValidationException
+from .scheduler import ChannelScheduler, classify_alert
+from .traffic import exchange, record_event
 
 from .utils import (
     call_slack,
     emit_to_mozdef,
+    get_access_token,
+    get_aws_client,
+    get_executor,
+    get_http_session,
+    is_rate_limited,
+    MessageShedException,
     provision_token,
     redirect_to_slack_authorize,
     SlackException
@@ -20,6 +30,110 @@ logging.getLogger('boto3').propagate = False
 logging.getLogger('botocore').propagate = False
 logging.getLogger('urllib3').propagate = False
 
+invoked = False
+
+
+BOT_RESPONSES = {
+    'yes': ':heavy_check_mark: Understood, thanks for letting us know.',
+    'no': (
+        ':open_mouth: Got it, thank you. Someone from the security team '
+        'will contact you to follow up on this.'),
+    'wronguser': (
+        ":flushed: Oh, sorry about that. Someone from the security team "
+        "will look into this and contact the right user. Sorry to bother "
+        "you."),
+    'notsure': (
+        ":ok_hand: No problem. Someone from the security team will "
+        "contact you to follow up on this."),
+    None: (
+        ":heavy_multiplication_x: Hmm, I had some kind of internal error. "
+        "Would you contact the security team to let them know that I'm "
+        "unwell?")
+}
+
+# Response blocks keyed by the user's response and whether or not the user
+# has changed their mind, built once per container instead of on every click
+RESPONSE_BLOCKS = {
+    (user_response, changed_mind): {
+        'block_id': 'mozdef-triage-bot-api-response',
+        'text': {
+            'text': (
+                "You've changed your mind, no problem. " + bot_response
+                if changed_mind else bot_response),
+            'type': "mrkdwn"
+        },
+        "type": "section"
+    }
+    for user_response, bot_response in BOT_RESPONSES.items()
+    for changed_mind in (False, True)
+}
+
+
+# Limits Slack places on the length of message fields
+# https://api.slack.com/reference/block-kit/blocks#section
+SECTION_TEXT_LIMIT = 3000
+# https://api.slack.com/reference/block-kit/block-elements#button
+BUTTON_VALUE_LIMIT = 2000
+
+
+def truncate_summary(summary: str, limit: int, identifier: str) -> str:
+    """Truncate an alert summary at a word boundary to fit within a limit
+
+    The truncated summary ends with a reference to the MozDef alert where the
+    full summary can be found
+
+    :param summary: The summary text of the alert
+    :param limit: The maximum number of characters the summary can be
+    :param identifier: The unique identifier of the MozDef alert
+    :return: The summary, truncated if it's longer than limit
+    """
+    if summary is None or len(summary) <= limit:
+        return summary
+    reference = ' ... [{} characters truncated, see MozDef alert {}]'
+    # Size the reference using the largest number of characters that could be
+    # truncated
+    cut = limit - len(reference.format(len(summary), identifier))
+    if cut <= 0:
+        # The reference doesn't fit so cut the summary at the limit
+        truncated = summary[:max(0, limit)]
+        stats.increment('summary_truncations')
+        logger.warning(
+            'Truncated the summary of MozDef alert {} from {} to {} '
+            'characters without a reference to the alert'.format(
+                identifier, len(summary), len(truncated)))
+        return truncated
+    boundary = summary.rfind(' ', 0, cut + 1)
+    if boundary < cut // 2:
+        # There's no word boundary near the cut so cut mid word
+        boundary = cut
+    truncated = summary[:boundary].rstrip()
+    stats.increment('summary_truncations')
+    logger.warning(
+        'Truncated the summary of MozDef alert {} from {} to {} '
+        'characters'.format(identifier, len(summary), len(truncated)))
+    return truncated + reference.format(
+        len(summary) - len(truncated), identifier)
+
+
+def truncate_json_string(value: str, overflow: int) -> str:
+    """Truncate a string so that its JSON encoding is shorter by overflow
+
+    Characters which are escaped when JSON encoded (e.g. non-ASCII characters
+    encoded as \\uXXXX) take up more than one character in the encoding so
+    the characters removed are measured by their encoded length
+
+    :param value: The string to truncate
+    :param overflow: The number of characters to remove from the JSON
+                     encoding of the string
+    :return: The truncated string, which may be empty
+    """
+    end = len(value)
+    while overflow > 0 and end > 0:
+        end -= 1
+        # json.dumps wraps the encoded character in quotes
+        overflow -= len(json.dumps(value[end])) - 2
+    return value[:end]
+
 
 def get_user_from_email(email: str) -> dict:
     """Fetch a slack user dictionary for an email address
@@ -67,14 +181,35 @@ def compose_message(
     :param identity_confidence: The identity confidence sent from MozDef
     :return: A Slack message dictionary
     """
-
-    default_response = {
-        'identifier': identifier,
-        'email': email,
-        'slack_name': user['name'],
-        'alert': alert,
-        'identity_confidence': identity_confidence
-    }
+    question = "\nWas this action taken by you ({})?".format(email)
+    if len(question) > SECTION_TEXT_LIMIT:
+        logger.warning(
+            'The question for MozDef alert {} is {} characters which is over '
+            'the Slack limit of {} characters'.format(
+                identifier, len(question), SECTION_TEXT_LIMIT))
+    summary = truncate_summary(
+        summary, SECTION_TEXT_LIMIT - len(question), identifier)
+
+    default_response = ButtonValue(
+        identifier, email, user['name'], alert, identity_confidence, None)
+    responses = ['yes', 'no', 'wronguser', 'notsure']
+    values = default_response.to_json_by_response(responses)
+    # Make room in the button values by truncating the alert name
+    overflow = max(len(x) for x in values.values()) - BUTTON_VALUE_LIMIT
+    if overflow > 0:
+        default_response.alert = truncate_json_string(alert, overflow)
+        values = default_response.to_json_by_response(responses)
+        stats.increment('button_value_truncations')
+        logger.warning(
+            'Truncated the alert name of MozDef alert {} by {} characters to '
+            'fit in the button values'.format(
+                identifier, len(alert) - len(default_response.alert)))
+        longest = max(len(x) for x in values.values())
+        if longest > BUTTON_VALUE_LIMIT:
+            logger.warning(
+                'The button values of MozDef alert {} are {} characters which '
+                'is over the Slack limit of {} characters'.format(
+                    identifier, longest, BUTTON_VALUE_LIMIT))
 
     # TODO : Add something that if the identity_confidence is high don't offer
     # the wronguser option
@@ -82,8 +217,7 @@ def compose_message(
         {
             "block_id": "mozdef-triage-bot-api-question",
             "text": {
-                "text": "{}\nWas this action taken by you ({})?".format(
-                    summary, email),
+                "text": "{}{}".format(summary, question),
                 "type": "mrkdwn",
             },
             "type": "section"
@@ -101,8 +235,7 @@ def compose_message(
                         "type": "plain_text"
                     },
                     "type": "button",
-                    "value": json.dumps(
-                        {**default_response, "response": "yes"})
+                    "value": values['yes']
                 },
                 {
                     "action_id": "mozdef-triage-bot-api-no",
@@ -133,7 +266,7 @@ def compose_message(
                             "text": "Are you sure?", "type": "plain_text"}
                     },
 
-                    "value": json.dumps({**default_response, "response": "no"})
+                    "value": values['no']
                 }
             ]
         }
@@ -164,8 +297,7 @@ def compose_message(
                     "title": {"text": "Are you sure?", "type": "plain_text"}
                 },
                 "type": "button",
-                "value": json.dumps(
-                    {**default_response, "response": "wronguser"})
+                "value": values['wronguser']
             }
         )
     blocks[1]['elements'].append(
@@ -176,7 +308,7 @@ def compose_message(
                 "type": "plain_text"
             },
             "type": "button",
-            "value": json.dumps({**default_response, "response": "notsure"})
+            "value": values['notsure']
         }
     )
     blocks_json = json.dumps(blocks)
@@ -223,8 +355,16 @@ def send_message_to_slack(
     :param identity_confidence: The identityConfidence sent by MozDef
                                 originally
     :return: A slack message dictionary
+    :raises MessageShedException: If the alert is low priority and Slack has
+                                  recently rate limited us
     """
     send_to_im = False
+    lane = classify_alert(alert, identity_confidence)
+    if lane == 'low' and is_rate_limited():
+        stats.increment('messages_shed')
+        raise MessageShedException(
+            'Shed low priority alert {} while Slack is busy'.format(
+                identifier))
     user = get_user_from_email(email_address)
     message = compose_message(
         identifier, alert, summary, email_address, user, identity_confidence)
@@ -236,6 +376,74 @@ def send_message_to_slack(
     return post_result
 
 
+def get_error_result(exception: Exception) -> dict:
+    """Build the result returned to MozDef for an alert which wasn't sent
+
+    Low priority alerts shed while Slack is busy are never sent. They're
+    marked with "shed" so that MozDef can tell them apart from alerts which
+    failed.
+
+    :param exception: The exception raised while sending the alert
+    :return: A dictionary with a "result" of the error encountered and
+             whether or not the alert was shed
+    """
+    result = {"result": str(exception)}
+    if isinstance(exception, MessageShedException):
+        result['shed'] = True
+    return result
+
+
+def send_messages_to_slack(alerts: list) -> list:
+    """Send messages for a batch of alerts, scheduling them per user
+
+    Messages are queued by user and sent with a ChannelScheduler so that many
+    alerts for one user are sent in order at the rate Slack allows while
+    alerts for other users are sent alongside them. Higher priority alerts
+    are sent first and low priority alerts may be shed under load.
+
+    :param alerts: A list of alert dictionaries, each with the same fields
+                   as a direct invocation event
+    :return: A list, in the order of the alerts, of either the slack message
+             dictionary or a dictionary from get_error_result of the error
+             encountered
+    """
+    results = [None] * len(alerts)
+    parsed_alerts = {}
+    for i, event in enumerate(alerts):
+        try:
+            parsed_alerts[i] = Alert.from_event(event)
+        except ValidationException as e:
+            results[i] = {"result": str(e)}
+    executor = get_executor()
+    # Look up each user once no matter how many alerts they have
+    user_futures = {
+        email: executor.submit(get_user_from_email, email)
+        for email in dict.fromkeys(
+            alert.email for alert in parsed_alerts.values())}
+    scheduler = ChannelScheduler(post_message, executor)
+    for i, alert in parsed_alerts.items():
+        try:
+            user = user_futures[alert.email].result()
+        except Exception as e:
+            results[i] = {"result": str(e)}
+            continue
+        message = compose_message(
+            alert.identifier,
+            alert.alert,
+            alert.summary,
+            alert.email,
+            user,
+            alert.identity_confidence)
+        scheduler.submit(
+            i, user['id'], message,
+            classify_alert(alert.alert, alert.identity_confidence))
+    for i, result in scheduler.drain().items():
+        results[i] = (
+            get_error_result(result) if isinstance(result, Exception)
+            else result)
+    return results
+
+
 def send_slack_message_response(
         response_url: str,
         message: dict,
@@ -247,54 +455,56 @@ def send_slack_message_response(
     :param user_response: The user's selection
     :return: Whether or not the response to the user succeeded
     """
-    if user_response == 'yes':
-        bot_response = (
-            ':heavy_check_mark: Understood, thanks for letting us know.')
-    elif user_response == 'no':
-        bot_response = (
-            ':open_mouth: Got it, thank you. Someone from the security team '
-            'will contact you to follow up on this.')
-    elif user_response == 'wronguser':
-        bot_response = (
-            ":flushed: Oh, sorry about that. Someone from the security team "
-            "will look into this and contact the right user. Sorry to bother "
-            "you.")
-    elif user_response == 'notsure':
-        bot_response = (
-            ":ok_hand: No problem. Someone from the security team will "
-            "contact you to follow up on this.")
+    # When CONFIG.response_mode is "compact" only the question and the
+    # response are sent back, dropping the action buttons
+    changed_mind = False
+    question_block = None
+    blocks = message.get('blocks', [])
+    for i in range(0, len(blocks)):
+        block_id = blocks[i].get('block_id')
+        if block_id == 'mozdef-triage-bot-api-response':
+            changed_mind = True
+            response_index = i
+            break
+        elif block_id == 'mozdef-triage-bot-api-question':
+            question_block = blocks[i]
     else:
-        bot_response = (
-            ":heavy_multiplication_x: Hmm, I had some kind of internal error. "
-            "Would you contact the security team to let them know that I'm "
-            "unwell?")
-
-    if 'mozdef-triage-bot-api-response' in [x.get('block_id') for x
-                                            in message.get('blocks', [])]:
-        bot_response = "You've changed your mind, no problem. " + bot_response
-    response_block = {
-        'block_id': 'mozdef-triage-bot-api-response',
-        'text': {
-            'text': bot_response,
-            'type': "mrkdwn"
-        },
-        "type": "section"
-    }
-    if 'blocks' in message:
-        for i in range(0, len(message['blocks'])):
-            if message['blocks'][i].get('block_id') == 'mozdef-triage-bot-api-response':
-                message['blocks'][i] = response_block
-                break
+        response_index = None
+    response_block = RESPONSE_BLOCKS.get(
+        (user_response, changed_mind),
+        RESPONSE_BLOCKS[(None, changed_mind)])
+
+    if CONFIG.response_mode == 'compact':
+        # Replace the actions block with the response instead of echoing the
+        # entire original message back to Slack
+        message = {
+            'blocks': ([question_block] if question_block is not None
+                       else []) + [response_block],
+            'text': message.get('text', '')}
+    elif 'blocks' in message:
+        if response_index is not None:
+            message['blocks'][response_index] = response_block
         else:
             message['blocks'].append(response_block)
 
+    import requests
     message['replace_original'] = True
-    try:
-        response = requests.post(
+
+    def post() -> dict:
+        response = get_http_session().post(
             url=response_url,
             json=message
         )
         response.raise_for_status()
+        return {'status_code': response.status_code}
+
+    try:
+        exchange(
+            'response_url',
+            'response_url',
+            {'response_url': response_url, 'json': message},
+            post,
+            {'response_url': response_url})
     except requests.exceptions.RequestException as e:
         logger.error(
             'POST of response to {} failed {} : {} : {} : {}'.format(
@@ -308,15 +518,45 @@ def send_slack_message_response(
     return True
 
 
-def handle_message_interaction(payload: dict) -> bool:
+def collect_message_action(
+        action: dict,
+        value: ButtonValue,
+        emit_future) -> dict:
+    """Wait for an action's MozDef emit to complete
+
+    :param action: The Slack action the user took
+    :param value: The value of the action
+    :param emit_future: The future of the call to emit_to_mozdef
+    :return: A dictionary of the outcome of the action
+    """
+    outcome = {
+        'action_id': action.get('action_id'),
+        'response': value.response,
+        'message_id': None}
+    try:
+        outcome['message_id'] = emit_future.result()
+    except Exception as e:
+        logger.error('Failed to emit action {} to MozDef : {}'.format(
+            action, e))
+        outcome['error'] = str(e)
+    return outcome
+
+
+def handle_message_interaction(payload: dict) -> dict:
     """Process a user's interaction with a Slack message
 
     payload['type'] :
-        'block_actions' : Parse the value that the user chose, send it to
+        'block_actions' : Parse the values that the user chose, send them to
                           MozDef and send a response to the user
     :param payload: A dictionary of data sent from Slack about a user's
                     interaction
-    :return: Whether or not the response to the user succeeded
+    If any action fails to be sent to MozDef the user is sent a follow up
+    response with the internal error message
+
+    :return: A dictionary with a "result" of whether or not every action was
+             sent to MozDef and the user was responded to, "responded"
+             whether or not the user was responded to and an "actions" list
+             of the outcome of sending each action to MozDef
     """
     # The right way to do this is
     # 1. Drop a message in a message queue (e.g. SQS) with the message to
@@ -325,46 +565,68 @@ def handle_message_interaction(payload: dict) -> bool:
     # 3. Pull that message off the queue
     # 4. POST to the response_url with the response message
     # Until that's added we'll just
-    # 1. POST to the response_url with the response message
+    # 1. POST to the response_url with the response message while sending
+    #    the response to MozDef
     # 2. Hope that the POST completes in under 3 seconds and return 200
     if payload.get('type') == 'block_actions':
         # User clicked a Block Kit interactive component
-        for action in payload.get('actions', []):
-            if 'value' not in action:
-                raise SlackException(
-                    'Action encountered with no value : {}'.format(action))
+        try:
+            interaction = Interaction.from_payload(payload)
+        except json.decoder.JSONDecodeError as e:
+            logger.error('Failed to parse button value in actions {} : '
+                         '{}'.format(payload.get('actions'), e))
+            raise
+        executor = get_executor()
+        emit_futures = [
+            executor.submit(
+                emit_to_mozdef,
+                value.identifier,
+                value.email,
+                interaction.slack_user_id,
+                value.slack_name,
+                value.identity_confidence,
+                value.response)
+            for _, value in interaction.actions]
+        # Every response replaces the same original message so only one
+        # response, to the last action, is sent while the emits run
+        responded = False
+        if interaction.actions:
+            try:
+                responded = send_slack_message_response(
+                    interaction.response_url,
+                    interaction.copy_message(),
+                    interaction.actions[-1][1].response)
+            except Exception as e:
+                logger.error('Failed to respond to actions {} : {}'.format(
+                    payload.get('actions'), e))
+        outcomes = [
+            collect_message_action(action, value, emit_future)
+            for (action, value), emit_future
+            in zip(interaction.actions, emit_futures)]
+        if responded and any('error' in x for x in outcomes):
+            # The user was told their response was received before it
+            # failed to reach MozDef so replace that with the internal error
+            # response
             try:
-                value = json.loads(action['value'])
-            except json.decoder.JSONDecodeError as e:
-                logger.error('Failed to parse button value "{}" : {}'.format(
-                    action['value'],
-                    e
-                ))
-                raise
-            message_id = emit_to_mozdef(
-                value.get('identifier'),
-                value.get('email'),
-                payload.get('user', {}).get('id'),
-                value.get('slack_name'),
-                value['identity_confidence'],
-                value.get('response')
-            )
-            allowed_keys = [
-                'text', 'blocks', 'attachments', 'thread_ts', 'mrkdwn']
-            original_message = {
-                k: v for k, v in
-                payload.get('message', {}).items()
-                if k in allowed_keys}
-            return send_slack_message_response(
-                payload.get('response_url'),
-                original_message,
-                value.get('response'))
+                send_slack_message_response(
+                    interaction.response_url,
+                    interaction.copy_message(),
+                    None)
+            except Exception as e:
+                logger.error(
+                    'Failed to tell the user about the failure of actions '
+                    '{} : {}'.format(payload.get('actions'), e))
+        return {
+            'result': responded and all(
+                x['message_id'] is not None for x in outcomes),
+            'responded': responded,
+            'actions': outcomes}
     else:
         # https://api.slack.com/interactivity/handling#payloads
         logger.error(
             "Encountered a message interaction payload type that hasn't yet "
             "been developed : {}".format(payload))
-        return False
+        return {'result': False, 'responded': False, 'actions': []}
 
 
 def process_api_call(
@@ -389,15 +651,30 @@ def process_api_call(
             'headers': {'Content-Type': 'text/html'},
             'statusCode': 200,
             'body': 'API request received'}
+    elif event.get('path') == '/stats':
+        return {
+            'headers': {'Content-Type': 'application/json'},
+            'statusCode': 200,
+            'body': json.dumps({
+                **stats.get_stats(),
+                'shedding_low_priority': is_rate_limited()})}
     elif event.get('path') == '/redirect_uri':
         return provision_token(query_string_parameters)
     elif event.get('path') == '/authorize':
         return redirect_to_slack_authorize()
     elif event.get('path') == '/slack/interactive-endpoint':
+        failed = False
         for payload_raw in body.get('payload', []):
             payload = json.loads(payload_raw)
             logger.debug('payload is {}'.format(payload))
             result = handle_message_interaction(payload)
+            if any('error' in x for x in result['actions']):
+                failed = True
+        if failed:
+            return {
+                'headers': {'Content-Type': 'text/html'},
+                'statusCode': 500,
+                'body': 'Error'}
         return {
             'headers': {'Content-Type': 'text/html'},
             'statusCode': 200,
@@ -415,6 +692,49 @@ def process_api_call(
             'body': "That path wasn't found"}
 
 
+def warm_up(cold_start: bool) -> dict:
+    """Initialize the caches and connections used when handling requests
+
+    Load the Slack access token, create the AWS clients, open a pooled
+    connection to Slack, start the thread pool and compose a message so that
+    the first real request served by this Lambda container is fast
+
+    :param cold_start: Whether or not this is the first invocation of this
+                       Lambda container
+    :return: A dictionary of whether this was a cold start and the time in
+             milliseconds each step took
+    """
+    steps = [
+        ('aws_clients', lambda: [get_aws_client(x) for x in ('ssm', 'sqs')]),
+        ('slack_token', lambda: get_access_token(CONFIG.slack_client_id)),
+        # auth.test checks the access token and opens a connection to Slack
+        # which is kept in the session's connection pool
+        ('slack_connection', lambda: call_slack(
+            'https://slack.com/api/auth.test', {}, 'user_id')),
+        ('executor', get_executor),
+        ('templates', lambda: compose_message(
+            'warmup', 'warmup', 'warmup', 'warmup@example.com',
+            {'name': 'warmup'}, 'low')),
+    ]
+    timings = {}
+    errors = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logger.error('Warm up step {} failed : {}'.format(name, e))
+            errors[name] = str(e)
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+    result = {
+        'result': 'warm',
+        'cold_start': cold_start,
+        'timings_ms': timings}
+    if errors:
+        result['errors'] = errors
+    return result
+
+
 def lambda_handler(event: dict, context: dict) -> dict:
     """Handler for all API Gateway requests
 
@@ -422,7 +742,11 @@ def lambda_handler(event: dict, context: dict) -> dict:
     :param context: Lambda context about the invocation and environment
     :return: An AWS API Gateway output dictionary for proxy mode
     """
+    global invoked
+    cold_start = not invoked
+    invoked = True
     logger.debug('event is {}'.format(event))
+    record_event(event)
     if event.get('resource') == '/{proxy+}':
         try:
             headers = event['headers'] if event['headers'] is not None else {}
@@ -454,17 +778,23 @@ def lambda_handler(event: dict, context: dict) -> dict:
         try:
             if event.get('action') == 'discover-sqs-queue-url':
                 result = {"result": CONFIG.queue_url}
+            elif event.get('action') == 'warmup':
+                result = warm_up(cold_start)
+            elif event.get('action') == 'send-messages':
+                result = {
+                    "result": send_messages_to_slack(event.get('alerts', []))}
             else:
+                alert = Alert.from_event(event)
                 try:
                     result = send_message_to_slack(
-                        event.get('identifier'),
-                        event.get('alert'),
-                        event.get('summary'),
-                        event.get('user'),
-                        event.get('identityConfidence')
+                        alert.identifier,
+                        alert.alert,
+                        alert.summary,
+                        alert.email,
+                        alert.identity_confidence
                     )
                 except SlackException as e:
-                    result = {"result": e}
+                    result = get_error_result(e)
         except Exception as e:
             result = {"result": str(e)}
         return result
\ No newline at end of file
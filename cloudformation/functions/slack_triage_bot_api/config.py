@@ -11,6 +11,41 @@ class Config:
         self.slack_client_id = os.getenv('SLACK_CLIENT_ID')
         self.slack_client_secret = os.getenv('SLACK_CLIENT_SECRET')
         self.queue_url = os.getenv('QUEUE_URL')
+        # "full" : Echo the original message back with the response added
+        # "compact" : Replace the action buttons with the response
+        self.response_mode = os.getenv('RESPONSE_MODE', 'full')
+        self.max_workers = int(os.getenv('MAX_WORKERS', 8))
+        # Slack allows roughly one message per second to each channel
+        self.slack_channel_interval = float(
+            os.getenv('SLACK_CHANNEL_INTERVAL', 1.0))
+        self.slack_max_retries = int(os.getenv('SLACK_MAX_RETRIES', 3))
+        # Priority lanes, see scheduler.classify_alert
+        self.high_priority_alerts = [x for x in os.getenv(
+            'HIGH_PRIORITY_ALERTS',
+            'duo_bypass_codes_generated,duo_bypass_codes_used').split(',')
+            if x]
+        self.low_priority_alerts = [x for x in os.getenv(
+            'LOW_PRIORITY_ALERTS', '').split(',') if x]
+        # Every lane must be able to send at least one message at a time
+        self.lane_concurrency = {
+            'high': max(1, int(os.getenv('HIGH_LANE_CONCURRENCY', 8))),
+            'normal': max(1, int(os.getenv('NORMAL_LANE_CONCURRENCY', 4))),
+            'low': max(1, int(os.getenv('LOW_LANE_CONCURRENCY', 1)))}
+        # The minimum number of seconds between sends in each lane
+        self.lane_interval = {
+            'high': float(os.getenv('HIGH_LANE_INTERVAL', 0)),
+            'normal': float(os.getenv('NORMAL_LANE_INTERVAL', 0.1)),
+            'low': float(os.getenv('LOW_LANE_INTERVAL', 1.0))}
+        # Shed low priority messages when more than this many messages are
+        # queued or for this many seconds after Slack's Retry-After period
+        self.shed_queue_depth = int(os.getenv('SHED_QUEUE_DEPTH', 100))
+        self.rate_limit_cooldown = float(
+            os.getenv('RATE_LIMIT_COOLDOWN', 30))
+        # "record" : Record calls to Slack and AWS to traffic_file
+        # "replay" : Serve calls to Slack and AWS from traffic_file
+        self.traffic_mode = os.getenv('TRAFFIC_MODE')
+        self.traffic_file = os.getenv(
+            'TRAFFIC_FILE', '/tmp/slack-triage-bot-traffic.jsonl')
 
 
 CONFIG = Config()
@@ -0,0 +1,208 @@
+import json
+from typing import Optional
+
+# These models declare __slots__ so that instances are compact and attribute
+# access is fast. They're plain classes rather than dataclasses because
+# importing dataclasses also imports inspect and ast, slowing cold starts.
+
+
+class ValidationException(Exception):
+    pass
+
+
+class Alert:
+    """An alert sent by MozDef to be posed to a user"""
+    __slots__ = (
+        'identifier', 'alert', 'summary', 'email', 'identity_confidence')
+
+    def __init__(
+            self,
+            identifier: Optional[str],
+            alert: Optional[str],
+            summary: Optional[str],
+            email: str,
+            identity_confidence: Optional[str]) -> None:
+        self.identifier = identifier
+        self.alert = alert
+        self.summary = summary
+        self.email = email
+        self.identity_confidence = identity_confidence
+
+    @classmethod
+    def from_event(cls, event: dict) -> 'Alert':
+        """Create an Alert from a direct Lambda invocation event
+
+        :param event: A dictionary of the alert sent by MozDef
+        :return: An Alert
+        """
+        email = event.get('user')
+        if not isinstance(email, str) or not email:
+            raise ValidationException(
+                'Alert has no user email address : {}'.format(event))
+        return cls(
+            event.get('identifier'),
+            event.get('alert'),
+            event.get('summary'),
+            email,
+            event.get('identityConfidence'))
+
+
+class ButtonValue:
+    """The value of a Slack message button, passed back to us by Slack when a
+    user clicks the button"""
+    __slots__ = (
+        'identifier', 'email', 'slack_name', 'alert', 'identity_confidence',
+        'response')
+
+    def __init__(
+            self,
+            identifier: Optional[str],
+            email: Optional[str],
+            slack_name: Optional[str],
+            alert: Optional[str],
+            identity_confidence: str,
+            response: Optional[str]) -> None:
+        self.identifier = identifier
+        self.email = email
+        self.slack_name = slack_name
+        self.alert = alert
+        self.identity_confidence = identity_confidence
+        self.response = response
+
+    @classmethod
+    def from_json(cls, value: str) -> 'ButtonValue':
+        """Parse the value of a button a user clicked
+
+        :param value: The JSON value of the button
+        :return: A ButtonValue
+        """
+        data = json.loads(value)
+        if not isinstance(data, dict) or 'identity_confidence' not in data:
+            raise ValidationException(
+                'Button value has no identity_confidence : {}'.format(value))
+        return cls(
+            data.get('identifier'),
+            data.get('email'),
+            data.get('slack_name'),
+            data.get('alert'),
+            data['identity_confidence'],
+            data.get('response'))
+
+    def to_json_by_response(self, responses: list) -> dict:
+        """Serialize this value once for each of several responses
+
+        The fields other than the response are serialized once and the
+        response is appended to them for each button
+
+        :param responses: A list of responses to serialize the value with
+        :return: A dictionary of each response to the JSON value
+        """
+        prefix = json.dumps({
+            'identifier': self.identifier,
+            'email': self.email,
+            'slack_name': self.slack_name,
+            'alert': self.alert,
+            'identity_confidence': self.identity_confidence
+        })[:-1]
+        return {
+            response: '{}, "response": {}}}'.format(
+                prefix, json.dumps(response))
+            for response in responses}
+
+
+class Interaction:
+    """A user's interaction with a Slack message"""
+    __slots__ = ('slack_user_id', 'response_url', 'message', 'actions')
+
+    # The keys of the original message to send back to Slack in a response
+    MESSAGE_KEYS = ('text', 'blocks', 'attachments', 'thread_ts', 'mrkdwn')
+
+    def __init__(
+            self,
+            slack_user_id: Optional[str],
+            response_url: Optional[str],
+            message: dict,
+            actions: list) -> None:
+        """
+        :param slack_user_id: The Slack ID of the user who interacted
+        :param response_url: The Slack URL to send message responses to
+        :param message: The original message the user interacted with
+        :param actions: A list of tuples of the Slack action dictionary and
+                        its ButtonValue
+        """
+        self.slack_user_id = slack_user_id
+        self.response_url = response_url
+        self.message = message
+        self.actions = actions
+
+    @classmethod
+    def from_payload(cls, payload: dict) -> 'Interaction':
+        """Parse a Slack block_actions interaction payload
+
+        :param payload: A dictionary of data sent from Slack about a user's
+                        interaction
+        :return: An Interaction
+        """
+        actions = []
+        for action in payload.get('actions', []):
+            if 'value' not in action:
+                raise ValidationException(
+                    'Action encountered with no value : {}'.format(action))
+            actions.append((action, ButtonValue.from_json(action['value'])))
+        message = payload.get('message', {})
+        return cls(
+            payload.get('user', {}).get('id'),
+            payload.get('response_url'),
+            {k: message[k] for k in cls.MESSAGE_KEYS if k in message},
+            actions)
+
+    def copy_message(self) -> dict:
+        """Copy the original message so that its list of blocks can be changed
+
+        :return: A dictionary of the original message
+        """
+        message = dict(self.message)
+        if 'blocks' in message:
+            message['blocks'] = list(message['blocks'])
+        return message
+
+
+class MozDefEvent:
+    """A user's response to an alert, sent to MozDef"""
+    __slots__ = (
+        'identifier', 'email', 'slack_user_id', 'slack_name',
+        'identity_confidence', 'response')
+
+    def __init__(
+            self,
+            identifier: Optional[str],
+            email: Optional[str],
+            slack_user_id: Optional[str],
+            slack_name: Optional[str],
+            identity_confidence: Optional[str],
+            response: Optional[str]) -> None:
+        self.identifier = identifier
+        self.email = email
+        self.slack_user_id = slack_user_id
+        self.slack_name = slack_name
+        self.identity_confidence = identity_confidence
+        self.response = response
+
+    def to_dict(self) -> dict:
+        """Build the MozDef event dictionary
+
+        :return: A dictionary of the event
+        """
+        return {
+            "category": "triagebot",
+            "details": {
+                "identifier": self.identifier,
+                "user": {
+                    "email": self.email,
+                    "slack": self.slack_user_id,
+                    "slackName": self.slack_name
+                },
+                "identityConfidence": self.identity_confidence,
+                "response": self.response
+            }
+        }
@@ -0,0 +1,211 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Callable, Hashable
+
+from . import stats
+from .config import CONFIG
+from .utils import get_retry_after, is_rate_limited, MessageShedException
+
+logger = logging.getLogger(__name__)
+logger.setLevel(CONFIG.log_level)
+
+# Priority lanes, highest priority first
+LANES = ('high', 'normal', 'low')
+
+
+def classify_alert(alert: str, identity_confidence: str) -> str:
+    """Determine the priority lane of an alert
+
+    * high : Alerts named in CONFIG.high_priority_alerts
+    * low : Alerts named in CONFIG.low_priority_alerts or where MozDef has
+            low confidence in the identity of the user
+    * normal : All other alerts
+
+    :param alert: The name of the MozDef alert
+    :param identity_confidence: The identityConfidence sent by MozDef
+    :return: The name of the lane
+    """
+    if alert in CONFIG.high_priority_alerts:
+        return 'high'
+    elif (alert in CONFIG.low_priority_alerts
+            or identity_confidence in ['low', 'lowest']):
+        return 'low'
+    return 'normal'
+
+
+def should_shed(queue_depth: int) -> bool:
+    """Whether or not to shed the lowest priority lane
+
+    :param queue_depth: The number of messages waiting to be sent
+    :return: True if Slack has recently rate limited us or queue_depth is
+             greater than CONFIG.shed_queue_depth
+    """
+    return is_rate_limited() or queue_depth > CONFIG.shed_queue_depth
+
+
+class ChannelScheduler:
+    """Send messages to Slack with a queue for each channel
+
+    Slack limits chat.postMessage to roughly one message per second per
+    channel. Rather than sending each message as soon as it's submitted,
+    messages are queued by channel and drained by sending at most one message
+    at a time to each channel, no more often than CONFIG.slack_channel_interval
+    seconds, taking channels in turn so that a burst of messages to one
+    channel doesn't hold up messages to other channels. Messages to a channel
+    are sent in the order they were submitted. Messages which Slack rate
+    limits are retried after the Retry-After period Slack returns.
+
+    Each message is in a priority lane. Channels whose next message is in a
+    higher priority lane are sent to first and each lane is limited to
+    CONFIG.lane_concurrency messages in flight and one message every
+    CONFIG.lane_interval seconds. While Slack is rate limiting us or too many
+    messages are queued, messages in the lowest priority lane are shed with a
+    MessageShedException instead of being sent. Shed messages are not sent
+    later.
+    """
+
+    def __init__(
+            self,
+            send: Callable[[str, dict], dict],
+            executor) -> None:
+        """
+        :param send: The function to send a message to a channel with
+        :param executor: The concurrent.futures Executor to send messages in
+        """
+        self.send = send
+        self.executor = executor
+        self.queues = {}
+        self.order = deque()
+        self.next_send = {}
+        self.lane_next_send = {lane: 0 for lane in LANES}
+        self.retries = {}
+
+    def submit(
+            self,
+            key: Hashable,
+            channel: str,
+            message: dict,
+            lane: str = 'normal') -> None:
+        """Queue a message to be sent to a channel
+
+        :param key: A unique key to identify the result of this message by
+        :param channel: The Slack channel ID to post the message to
+        :param message: The message to post
+        :param lane: The priority lane of the message
+        :return: None
+        """
+        if channel not in self.queues:
+            self.queues[channel] = deque()
+            self.order.append(channel)
+            self.next_send[channel] = 0
+        self.queues[channel].append((key, message, lane))
+
+    def shed(self, results: dict) -> None:
+        """Shed every queued message in the lowest priority lane
+
+        :param results: The dictionary of results to record the shed messages
+                        in
+        :return: None
+        """
+        lowest_lane = LANES[-1]
+        for channel, queue in self.queues.items():
+            kept = deque()
+            for key, message, lane in queue:
+                if lane == lowest_lane:
+                    results[key] = MessageShedException(
+                        'Shed {} priority message to {} while Slack is '
+                        'busy'.format(lane, channel))
+                    stats.increment('messages_shed')
+                else:
+                    kept.append((key, message, lane))
+            self.queues[channel] = kept
+
+    def dispatch(self, in_flight: dict, now: float) -> float:
+        """Start sending the next message of each channel that's ready
+
+        :param in_flight: A dictionary of futures of messages being sent to
+                          the channel, key, message and lane being sent
+        :param now: The current time.monotonic() time
+        :return: The time.monotonic() time at which the next idle channel will
+                 be ready to send or None if there are no idle channels
+        """
+        busy = {channel for channel, _, _, _ in in_flight.values()}
+        lane_in_flight = {lane: 0 for lane in LANES}
+        for _, _, _, lane in in_flight.values():
+            lane_in_flight[lane] += 1
+        for _ in range(len(self.order)):
+            channel = self.order.popleft()
+            if self.queues[channel]:
+                self.order.append(channel)
+            # else there's nothing left to send to this channel
+        next_ready = None
+        for lane in LANES:
+            for channel in list(self.order):
+                if (channel in busy
+                        or self.queues[channel][0][2] != lane
+                        or lane_in_flight[lane] >= CONFIG.lane_concurrency[
+                            lane]):
+                    continue
+                ready = max(self.next_send[channel],
+                            self.lane_next_send[lane])
+                if ready > now:
+                    next_ready = (ready if next_ready is None
+                                  else min(next_ready, ready))
+                    continue
+                key, message, _ = self.queues[channel].popleft()
+                future = self.executor.submit(self.send, channel, message)
+                in_flight[future] = (channel, key, message, lane)
+                busy.add(channel)
+                lane_in_flight[lane] += 1
+                self.next_send[channel] = now + CONFIG.slack_channel_interval
+                self.lane_next_send[lane] = now + CONFIG.lane_interval[lane]
+                # Move the channel to the back so other channels go first
+                self.order.remove(channel)
+                self.order.append(channel)
+        return next_ready
+
+    def drain(self) -> dict:
+        """Send all queued messages, returning once every message is sent
+
+        :return: A dictionary of the key of each message to either the result
+                 of sending it or the exception raised while sending it
+        """
+        results = {}
+        in_flight = {}
+        while self.order or in_flight:
+            if should_shed(sum(len(x) for x in self.queues.values())):
+                self.shed(results)
+            now = time.monotonic()
+            next_ready = self.dispatch(in_flight, now)
+            timeout = (None if next_ready is None
+                       else max(0, next_ready - time.monotonic()))
+            if not in_flight:
+                if timeout is not None:
+                    time.sleep(timeout)
+                continue
+            done, _ = wait(
+                in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                channel, key, message, lane = in_flight.pop(future)
+                try:
+                    results[key] = future.result()
+                    continue
+                except Exception as e:
+                    exception = e
+                retry_after = get_retry_after(exception)
+                if (retry_after is not None and self.retries.get(key, 0)
+                        < CONFIG.slack_max_retries):
+                    logger.info(
+                        'Slack rate limited sending to {}, retrying in {} '
+                        'seconds'.format(channel, retry_after))
+                    self.retries[key] = self.retries.get(key, 0) + 1
+                    stats.increment('slack_retries')
+                    self.queues[channel].appendleft((key, message, lane))
+                    if channel not in self.order:
+                        self.order.append(channel)
+                    self.next_send[channel] = time.monotonic() + retry_after
+                else:
+                    results[key] = exception
+        return results
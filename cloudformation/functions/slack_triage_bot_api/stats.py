@@ -0,0 +1,112 @@
+import threading
+import time
+
+# Each thread increments counters in its own dictionary so that incrementing
+# a counter on the hot path never waits on a lock. Reading a counter sums the
+# dictionaries of every thread.
+local = threading.local()
+shards = []
+shards_lock = threading.Lock()
+container_start = time.time()
+
+
+def get_shard() -> dict:
+    """Fetch the current thread's counters, creating them on first use
+
+    :return: The dictionary of counters for the current thread
+    """
+    shard = getattr(local, 'counters', None)
+    if shard is None:
+        shard = local.counters = {'counters': {}, 'latencies': {}}
+        # The lock is only taken once per thread to register its counters
+        with shards_lock:
+            shards.append(shard)
+    return shard
+
+
+def increment(name: str, value: int = 1) -> None:
+    """Increment a counter
+
+    :param name: The name of the counter
+    :param value: The amount to increment the counter by
+    :return: None
+    """
+    counters = get_shard()['counters']
+    counters[name] = counters.get(name, 0) + value
+
+
+def observe(name: str, milliseconds: float) -> None:
+    """Record the latency of a call
+
+    :param name: The name of the kind of call
+    :param milliseconds: How long the call took
+    :return: None
+    """
+    latencies = get_shard()['latencies']
+    if name not in latencies:
+        latencies[name] = [0, 0.0, 0.0]
+    latency = latencies[name]
+    latency[0] += 1
+    latency[1] += milliseconds
+    latency[2] = max(latency[2], milliseconds)
+
+
+def get_counters() -> dict:
+    """Sum the counters of every thread
+
+    :return: A dictionary of counter names to values
+    """
+    counters = {}
+    for shard in list(shards):
+        for name, value in dict(shard['counters']).items():
+            counters[name] = counters.get(name, 0) + value
+    return counters
+
+
+def get_latencies() -> dict:
+    """Combine the latencies recorded by every thread
+
+    :return: A dictionary of call names to a dictionary of the number of
+             calls and the mean and maximum latency in milliseconds
+    """
+    totals = {}
+    for shard in list(shards):
+        for name, (count, total, maximum) in dict(
+                shard['latencies']).items():
+            if name not in totals:
+                totals[name] = [0, 0.0, 0.0]
+            totals[name][0] += count
+            totals[name][1] += total
+            totals[name][2] = max(totals[name][2], maximum)
+    return {
+        name: {
+            'count': count,
+            'mean_ms': round(total / count, 1),
+            'max_ms': round(maximum, 1)}
+        for name, (count, total, maximum) in totals.items()}
+
+
+def get_hit_rate(name: str, counters: dict) -> float:
+    """Calculate the hit rate of a cache from its hit and miss counters
+
+    :param name: The name of the cache
+    :param counters: A dictionary of counters from get_counters
+    :return: The fraction of lookups which were hits or None if there have
+             been no lookups
+    """
+    hits = counters.get('{}_cache_hits'.format(name), 0)
+    misses = counters.get('{}_cache_misses'.format(name), 0)
+    return round(hits / (hits + misses), 3) if hits + misses else None
+
+
+def get_stats() -> dict:
+    """Report the counters and latencies of this Lambda container
+
+    :return: A dictionary of statistics
+    """
+    counters = get_counters()
+    return {
+        'container_age_seconds': round(time.time() - container_start, 1),
+        'access_token_cache_hit_rate': get_hit_rate('access_token', counters),
+        'counters': counters,
+        'latencies': get_latencies()}
@@ -0,0 +1,299 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+from typing import Callable, Optional
+
+from . import stats
+from .config import CONFIG
+
+logger = logging.getLogger(__name__)
+logger.setLevel(CONFIG.log_level)
+
+# Keys whose string values are replaced with a pseudonym before a trace is
+# written. Slack user and channel IDs (id, channel, slack, users) identify
+# users so they're pseudonymized too.
+SENSITIVE_KEYS = {
+    'access_token',
+    'Authorization',
+    'channel',
+    'client_secret',
+    'code',
+    'Cookie',
+    'display_name',
+    'display_name_normalized',
+    'email',
+    'first_name',
+    'id',
+    'last_name',
+    'name',
+    'phone',
+    'real_name',
+    'real_name_normalized',
+    'response_url',
+    'slack',
+    'slackName',
+    'slack_name',
+    'sourceIp',
+    'summary',
+    'text',
+    'title',
+    'token',
+    'user',
+    'username',
+    'users',
+}
+# Keys whose string values are JSON which is decoded, sanitized and encoded
+# again
+EMBEDDED_JSON_KEYS = {'blocks', 'payload', 'value'}
+EMAIL_PATTERN = re.compile(r'[\w.+-]+@[\w-]+(\.[\w-]+)+')
+REDACTED = 'REDACTED'
+# Pseudonyms are salted per container so they can be matched against each
+# other within a recording but can't be used to confirm a guessed value
+PSEUDONYM_SALT = os.urandom(16)
+
+trace_file_lock = threading.Lock()
+replay_lock = threading.Lock()
+replay_traces = None
+
+
+class TrafficReplayException(Exception):
+    pass
+
+
+def pseudonymize(value: str) -> str:
+    """Replace a sensitive value with a pseudonym
+
+    The same value is always given the same pseudonym within a Lambda
+    container so that replayed requests can be matched to recorded requests.
+    Pseudonyms are left as they are.
+
+    :param value: The sensitive value
+    :return: The pseudonym
+    """
+    if value.startswith(REDACTED):
+        return value
+    return '{}-{}'.format(REDACTED, hashlib.sha256(
+        PSEUDONYM_SALT + value.encode('utf-8')).hexdigest()[:12])
+
+
+def sanitize(data, key: str = None):
+    """Return a copy of a structure with sensitive values replaced with
+    pseudonyms
+
+    :param data: A dictionary, list or scalar to sanitize
+    :param key: The dictionary key data was found under
+    :return: The sanitized copy
+    """
+    if isinstance(data, dict):
+        return {k: sanitize(v, k) for k, v in data.items()}
+    elif isinstance(data, (list, tuple)):
+        return [sanitize(x, key) for x in data]
+    elif not isinstance(data, str):
+        return data
+    elif key in EMBEDDED_JSON_KEYS:
+        try:
+            return json.dumps(sanitize(json.loads(data)))
+        except ValueError:
+            return pseudonymize(data)
+    elif key in SENSITIVE_KEYS:
+        return pseudonymize(data)
+    return EMAIL_PATTERN.sub(lambda x: pseudonymize(x.group(0)), data)
+
+
+def sanitize_event(event: dict) -> dict:
+    """Return a copy of a Lambda event with sensitive values replaced with
+    pseudonyms
+
+    Slack interaction payloads arrive URL encoded in the body of API Gateway
+    events so they're decoded, sanitized and encoded again
+
+    :param event: The Lambda event
+    :return: The sanitized event
+    """
+    body = event.get('body')
+    event = sanitize({k: v for k, v in event.items() if k != 'body'})
+    if (isinstance(body, str)
+            and (event.get('headers') or {}).get('Content-Type')
+            == 'application/x-www-form-urlencoded'):
+        event['body'] = urllib.parse.urlencode(
+            sanitize(urllib.parse.parse_qs(body)), doseq=True)
+    elif body is not None:
+        event['body'] = sanitize(body, 'payload')
+    return event
+
+
+def write_trace(trace: dict) -> None:
+    """Append a trace to the traffic file
+
+    :param trace: The trace to record
+    :return: None
+    """
+    line = json.dumps(trace, default=str)
+    with trace_file_lock:
+        with open(CONFIG.traffic_file, 'a') as f:
+            f.write(line + '\n')
+
+
+def load_traces() -> dict:
+    """Load the recorded traces from the traffic file, grouped by the kind
+    and target of the call
+
+    Must be called while holding replay_lock
+
+    :return: A dictionary of (kind, target) tuples to a list of traces in the
+             order they were recorded
+    """
+    global replay_traces
+    if replay_traces is None:
+        traces = defaultdict(list)
+        with open(CONFIG.traffic_file) as f:
+            for line in f:
+                if line.strip():
+                    trace = json.loads(line)
+                    if trace['kind'] != 'event':
+                        traces[(trace['kind'], trace['target'])].append(trace)
+        replay_traces = traces
+    return replay_traces
+
+
+def find_trace(kind: str, target: str, match: dict) -> dict:
+    """Remove and return the earliest recorded trace of a call
+
+    :param kind: The kind of call
+    :param target: The target of the call
+    :param match: The sanitized values identifying the call
+    :return: The trace
+    """
+    with replay_lock:
+        traces = load_traces()[(kind, target)]
+        for i in range(0, len(traces)):
+            if traces[i]['match'] == match:
+                return traces.pop(i)
+    raise TrafficReplayException(
+        'No recorded {} traffic to {} left to replay matching {}'.format(
+            kind, target, match))
+
+
+def raise_recorded_error(trace: dict) -> None:
+    """Raise the error recorded in a trace
+
+    HTTP errors are raised as a requests HTTPError with a response carrying
+    the recorded status code and headers so that they're handled like the
+    original error
+
+    :param trace: The trace of a call which raised an error
+    :return: None
+    """
+    if 'status_code' not in trace:
+        raise TrafficReplayException(trace['error'])
+    import requests
+    from requests.structures import CaseInsensitiveDict
+    response = requests.Response()
+    response.status_code = trace['status_code']
+    response.headers = CaseInsensitiveDict(trace.get('headers', {}))
+    response._content = b''
+    raise requests.exceptions.HTTPError(trace['error'], response=response)
+
+
+def record_event(event: dict) -> None:
+    """Record an inbound Lambda event when in record mode
+
+    :param event: The Lambda event
+    :return: None
+    """
+    if CONFIG.traffic_mode == 'record':
+        write_trace({
+            'kind': 'event',
+            'timestamp': time.time(),
+            'event': sanitize_event(event)})
+
+
+def exchange(
+        kind: str,
+        target: str,
+        request: dict,
+        perform: Callable[[], dict],
+        match: Optional[dict] = None) -> dict:
+    """Perform, record or replay a call to Slack or AWS, counting the call
+    and its latency
+
+    :param kind: The kind of call (e.g. 'slack', 'sqs', 'response_url')
+    :param target: What is being called (e.g. the Slack API method URL)
+    :param request: The request being made, recorded for reference
+    :param perform: A function which makes the call and returns a JSON
+                    serializable response
+    :param match: The values identifying this call, used to find the
+                  recording of this call when replaying
+    :return: The response
+    """
+    start = time.perf_counter()
+    try:
+        return record_or_replay(kind, target, request, perform, match)
+    except Exception:
+        stats.increment('{}_errors'.format(kind))
+        raise
+    finally:
+        stats.observe(kind, (time.perf_counter() - start) * 1000)
+
+
+def record_or_replay(
+        kind: str,
+        target: str,
+        request: dict,
+        perform: Callable[[], dict],
+        match: Optional[dict] = None) -> dict:
+    """Perform, record or replay a call to Slack or AWS
+
+    With CONFIG.traffic_mode set to
+    * "record" : Perform the call and append the sanitized request, response
+                 or error and latency to the traffic file
+    * "replay" : Find the earliest recorded call with the same kind, target
+                 and match in the traffic file and, after waiting for the
+                 recorded latency, return its response or raise its error
+    * anything else : Perform the call
+
+    :param kind: The kind of call (e.g. 'slack', 'sqs', 'response_url')
+    :param target: What is being called (e.g. the Slack API method URL)
+    :param request: The request being made, recorded for reference
+    :param perform: A function which makes the call and returns a JSON
+                    serializable response
+    :param match: The values identifying this call, used to find the
+                  recording of this call when replaying
+    :return: The response
+    """
+    if CONFIG.traffic_mode == 'replay':
+        trace = find_trace(kind, target, sanitize(match or {}))
+        time.sleep(trace['latency_ms'] / 1000)
+        if 'error' in trace:
+            raise_recorded_error(trace)
+        return trace['response']
+    elif CONFIG.traffic_mode != 'record':
+        return perform()
+
+    trace = {
+        'kind': kind,
+        'target': target,
+        'timestamp': time.time(),
+        'match': sanitize(match or {}),
+        'request': sanitize(request)}
+    start = time.perf_counter()
+    try:
+        response = perform()
+        trace['response'] = sanitize(response)
+        return response
+    except Exception as e:
+        trace['error'] = sanitize('{} : {}'.format(type(e).__name__, e))
+        error_response = getattr(e, 'response', None)
+        if getattr(error_response, 'status_code', None) is not None:
+            trace['status_code'] = error_response.status_code
+            trace['headers'] = sanitize(dict(error_response.headers))
+        raise
+    finally:
+        trace['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        write_trace(trace)
@@ -1,19 +1,110 @@
 import logging
 import json
+import threading
+import time
 from typing import Optional
-import boto3
-import requests
 
+from . import stats
 from .config import CONFIG
+from .models import MozDefEvent
+from .traffic import exchange
+
+# boto3 and requests are imported on first use instead of at module load so
+# that API routes which don't call AWS or Slack (e.g. /test, /authorize) don't
+# pay for importing them during a cold start
 
 logger = logging.getLogger(__name__)
 logger.setLevel(CONFIG.log_level)
 
+aws_clients = {}
+http_session = None
+executor = None
+rate_limited_until = 0.0
+# Creating boto3 clients and fetching the access token happen on first use,
+# which may be in several executor threads at once. boto3.client() isn't
+# thread safe so these are created under locks.
+aws_clients_lock = threading.Lock()
+http_session_lock = threading.Lock()
+access_token_lock = threading.Lock()
+
 
 class SlackException(Exception):
     pass
 
 
+class MessageShedException(SlackException):
+    pass
+
+
+def get_retry_after(exception: Exception) -> Optional[float]:
+    """Determine how long Slack asked us to wait before retrying a call
+
+    :param exception: The exception raised by the call to Slack
+    :return: The number of seconds to wait or None if the call wasn't rate
+             limited
+    """
+    response = getattr(exception, 'response', None)
+    if getattr(response, 'status_code', None) != 429:
+        return None
+    try:
+        return float(response.headers.get('Retry-After', 1))
+    except ValueError:
+        return 1.0
+
+
+def is_rate_limited() -> bool:
+    """Whether or not Slack has rate limited this Lambda container recently
+
+    :return: True if a Slack Retry-After period, extended by
+             CONFIG.rate_limit_cooldown seconds, hasn't yet passed
+    """
+    return time.monotonic() < rate_limited_until
+
+
+def get_aws_client(service_name: str):
+    """Fetch a boto3 client for an AWS service from cache or create it
+
+    :param service_name: The name of the AWS service (e.g. 'ssm' or 'sqs')
+    :return: A boto3 client for the service
+    """
+    if service_name not in aws_clients:
+        with aws_clients_lock:
+            if service_name not in aws_clients:
+                import boto3
+                aws_clients[service_name] = boto3.client(service_name)
+    return aws_clients[service_name]
+
+
+def get_http_session():
+    """Fetch the shared requests Session, creating it on first use
+
+    Reusing a single Session keeps HTTPS connections to Slack pooled across
+    calls made within the same Lambda container
+
+    :return: A requests Session
+    """
+    global http_session
+    if http_session is None:
+        with http_session_lock:
+            if http_session is None:
+                import requests
+                http_session = requests.Session()
+    return http_session
+
+
+def get_executor():
+    """Fetch the shared thread pool used to run Slack and AWS calls
+    concurrently, creating it on first use
+
+    :return: A concurrent.futures ThreadPoolExecutor
+    """
+    global executor
+    if executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=CONFIG.max_workers)
+    return executor
+
+
 def store_oauth_token(client_id: str, access_token: str) -> dict:
     """Store an OAuth 2 access token in SSM parameter store
 
@@ -22,7 +113,7 @@ def store_oauth_token(client_id: str, access_token: str) -> dict:
     :return: dictionary containing the "Version" and "Tier" of the stored
              parameter
     """
-    client = boto3.client('ssm')
+    client = get_aws_client('ssm')
     name = '{}-{}'.format(
         CONFIG.slack_token_parameter_store_name, client_id)
     response_put = client.put_parameter(
@@ -57,8 +148,15 @@ def get_access_token(client_id: str) -> dict:
     global access_token
     if 'access_token' not in globals():
         access_token = {}
-    if client_id not in access_token:
-        client = boto3.client('ssm')
+    if client_id in access_token:
+        stats.increment('access_token_cache_hits')
+        return access_token
+    with access_token_lock:
+        if client_id in access_token:
+            stats.increment('access_token_cache_hits')
+            return access_token
+        stats.increment('access_token_cache_misses')
+        client = get_aws_client('ssm')
         response = client.get_parameter(
             Name='{}-{}'.format(
                 CONFIG.slack_token_parameter_store_name, client_id),
@@ -86,28 +184,31 @@ def emit_to_mozdef(
     :param response: The user's response
     :return: The message ID returned from SQS after sending the message
     """
-    data = {
-        "category": "triagebot",
-        "details": {
-            "identifier": identifier,
-            "user": {
-                "email": email,
-                "slack": slack_user_id,
-                "slackName": slack_name
-            },
-            "identityConfidence": identity_confidence,
-            "response": response
-        }
-    }
+    data = MozDefEvent(
+        identifier,
+        email,
+        slack_user_id,
+        slack_name,
+        identity_confidence,
+        response
+    ).to_dict()
     logger.debug('Sending to SQS : {}'.format(data))
-    client = boto3.client('sqs')
-    response = client.send_message(
-        QueueUrl=CONFIG.queue_url,
-        MessageBody=json.dumps(data)
-    )
+    response = exchange(
+        'sqs',
+        'send_message',
+        {'queue_url': CONFIG.queue_url, 'body': data},
+        lambda: get_aws_client('sqs').send_message(
+            QueueUrl=CONFIG.queue_url,
+            MessageBody=json.dumps(data)
+        ),
+        {'identifier': identifier, 'response': response})
     return response['MessageId']
 
 
+# The fields of a call to Slack which identify it when replaying traffic
+SLACK_MATCH_KEYS = ('channel', 'email', 'users')
+
+
 def call_slack(
         url: str,
         data: dict,
@@ -123,26 +224,43 @@ def call_slack(
                          or a URL encoded payload
     :return: The response from Slack based on the key_to_return
     """
-    access_token = get_access_token(CONFIG.slack_client_id)
-    headers = {
-        'Authorization': 'Bearer {}'.format(
-            access_token[CONFIG.slack_client_id])}
-    try:
+    global rate_limited_until
+    import requests
+
+    def post() -> dict:
+        access_token = get_access_token(CONFIG.slack_client_id)
+        headers = {
+            'Authorization': 'Bearer {}'.format(
+                access_token[CONFIG.slack_client_id])}
         if post_as_json:
-            response = requests.post(url, json=data, headers=headers)
+            response = get_http_session().post(
+                url, json=data, headers=headers)
         else:
-            response = requests.post(url, data=data, headers=headers)
+            response = get_http_session().post(
+                url, data=data, headers=headers)
         response.raise_for_status()
-        if not response.json().get('ok'):
+        return response.json()
+
+    try:
+        result = exchange(
+            'slack', url, {'url': url, 'data': data}, post,
+            {k: data[k] for k in SLACK_MATCH_KEYS if k in data})
+        if not result.get('ok'):
             raise SlackException(
                 {
-                    'error': response.json().get('error'),
+                    'error': result.get('error'),
                     'url': url,
                     'data': data,
-                    'response': response.json()
+                    'response': result
                 }
             )
     except requests.exceptions.RequestException as e:
+        retry_after = get_retry_after(e)
+        if retry_after is not None:
+            stats.increment('slack_rate_limited')
+            rate_limited_until = max(
+                rate_limited_until,
+                time.monotonic() + retry_after + CONFIG.rate_limit_cooldown)
         logger.error(
             'POST of response to {} failed {} : {} : {} : {}'.format(
                 url,
@@ -154,9 +272,9 @@ def call_slack(
         raise
     logger.debug('Called slack with {} and received response of {}'.format(
         data,
-        response.json()
+        result
     ))
-    return response.json().get(key_to_return)
+    return result.get(key_to_return)
 
 
 def provision_token(query_string_parameters: dict) -> dict:
@@ -173,6 +291,7 @@ def provision_token(query_string_parameters: dict) -> dict:
             'headers': {'Content-Type': 'text/html'},
             'statusCode': 400,
             'body': "Unable to provision and store an OAuth access token"}
+    import requests
     data = {
         'code': query_string_parameters.get('code'),
         'client_id': CONFIG.slack_client_id,
@@ -180,7 +299,7 @@ def provision_token(query_string_parameters: dict) -> dict:
     }
     url = 'https://slack.com/api/oauth.v2.access'
     try:
-        response = requests.post(
+        response = get_http_session().post(
             url=url,
             data=data
         )
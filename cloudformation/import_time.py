@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Report and enforce the import time of the Lambda handler module
+
+Runs ``python -X importtime`` against the handler module in a fresh
+interpreter, prints the slowest imports and exits non-zero if the
+cumulative import time of the handler module exceeds the budget or if
+importing the handler imports any of the modules which must only be imported
+on first use (boto3, botocore and requests).
+
+Usage : python import_time.py [--budget-ms 60] [--top 15]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+HANDLER_MODULE = 'slack_triage_bot_api.app'
+# Modules which are slow to import and so must not be imported by the handler
+# module at load time
+LAZY_MODULES = ('boto3', 'botocore', 'requests')
+FUNCTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'functions')
+
+
+def measure_imports(module: str) -> list:
+    """Import a module in a fresh interpreter and collect import timings
+
+    :param module: The dotted name of the module to import
+    :return: A list of (self_us, cumulative_us, name) tuples in import order
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [FUNCTIONS_PATH] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        env=env,
+        stderr=subprocess.PIPE,
+        universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('Unable to import {} : {}'.format(
+            module, result.stderr))
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return timings
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--budget-ms', type=float,
+        default=float(os.getenv('IMPORT_TIME_BUDGET_MS', 60)),
+        help='Maximum cumulative import time of the handler module')
+    parser.add_argument(
+        '--top', type=int, default=15,
+        help='Number of slowest imports to report')
+    args = parser.parse_args()
+
+    timings = measure_imports(HANDLER_MODULE)
+    print('{:>12} {:>12}  {}'.format('self [us]', 'cumul [us]', 'module'))
+    for self_us, cumulative_us, name in sorted(
+            timings, key=lambda x: x[1], reverse=True)[:args.top]:
+        print('{:>12} {:>12}  {}'.format(self_us, cumulative_us, name))
+
+    total_ms = next(
+        cumulative_us for _, cumulative_us, name in timings
+        if name.strip() == HANDLER_MODULE) / 1000
+    print('\n{} imported in {:.1f} ms (budget {:.1f} ms)'.format(
+        HANDLER_MODULE, total_ms, args.budget_ms))
+    failed = False
+    if total_ms > args.budget_ms:
+        print('Import time budget exceeded')
+        failed = True
+    eager = sorted({
+        name.strip() for _, _, name in timings
+        if name.strip().split('.')[0] in LAZY_MODULES})
+    if eager:
+        print('Modules which must be imported on first use were imported at '
+              'load time : {}'.format(', '.join(eager)))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Replay recorded traffic through the Lambda handler and report latencies
+
+Traffic is recorded by deploying or running the function with
+TRAFFIC_MODE=record which writes the inbound events and the sanitized calls
+to Slack and AWS, with their latencies, to TRAFFIC_FILE. This replays those
+events through lambda_handler with TRAFFIC_MODE=replay so that calls to Slack
+and AWS are served from the recording after the recorded latency.
+
+Usage : python replay.py [--speed 1.0] [--concurrency 8] traffic.jsonl
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+FUNCTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'functions')
+
+
+def load_events(traffic_file: str) -> list:
+    """Load the recorded inbound Lambda events from a traffic file
+
+    :param traffic_file: The path to the recorded traffic file
+    :return: A list of (timestamp, event) tuples in the order they arrived
+    """
+    events = []
+    with open(traffic_file) as f:
+        for line in f:
+            if line.strip():
+                trace = json.loads(line)
+                if trace['kind'] == 'event':
+                    events.append((trace['timestamp'], trace['event']))
+    return sorted(events, key=lambda x: x[0])
+
+
+def is_failure(event: dict, result) -> bool:
+    """Determine whether or not an invocation of the handler failed
+
+    :param event: The Lambda event
+    :param result: What the handler returned
+    :return: True if the handler returned nothing, an HTTP error or an error
+             result
+    """
+    if result is None:
+        return True
+    elif 'statusCode' in result:
+        return result['statusCode'] >= 400
+    elif event.get('action') in ('discover-sqs-queue-url', 'warmup'):
+        return False
+    elif event.get('action') == 'send-messages':
+        return any(
+            x is None or list(x) == ['result']
+            for x in result.get('result', []))
+    # Direct invocations return the Slack message or a dictionary containing
+    # only the "result" of an error
+    return list(result) == ['result']
+
+
+def percentile(values: list, fraction: float) -> float:
+    """Return the value at a fraction of the way through sorted values
+
+    :param values: A sorted list of numbers
+    :param fraction: A number between 0 and 1
+    :return: The value at that fraction
+    """
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('traffic_file', help='The recorded traffic file')
+    parser.add_argument(
+        '--speed', type=float, default=1.0,
+        help='Multiple of the recorded arrival rate to replay events at. 0 '
+             'replays events as fast as possible')
+    parser.add_argument(
+        '--concurrency', type=int, default=8,
+        help='Number of events to process at the same time, simulating '
+             'concurrent Lambda invocations')
+    args = parser.parse_args()
+
+    # These must be set before the function's config is imported
+    os.environ['TRAFFIC_MODE'] = 'replay'
+    os.environ['TRAFFIC_FILE'] = args.traffic_file
+    sys.path.insert(0, FUNCTIONS_PATH)
+    from slack_triage_bot_api import stats
+    from slack_triage_bot_api.app import lambda_handler
+
+    events = load_events(args.traffic_file)
+    if not events:
+        print('No recorded events found in {}'.format(args.traffic_file))
+        return 1
+
+    def invoke(event: dict) -> tuple:
+        start = time.perf_counter()
+        try:
+            failed = is_failure(event, lambda_handler(event, {}))
+        except Exception as e:
+            print('Invocation raised {} : {}'.format(type(e).__name__, e))
+            failed = True
+        return (time.perf_counter() - start) * 1000, failed
+
+    first_timestamp = events[0][0]
+    replay_start = time.perf_counter()
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for timestamp, event in events:
+            if args.speed > 0:
+                delay = ((timestamp - first_timestamp) / args.speed
+                         - (time.perf_counter() - replay_start))
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(invoke, event))
+    results = [x.result() for x in futures]
+    latencies = sorted(latency for latency, _ in results)
+    failures = sum(1 for _, failed in results if failed)
+    elapsed = time.perf_counter() - replay_start
+
+    print('Replayed {} events in {:.2f} s ({:.1f} events/s)'.format(
+        len(latencies), elapsed, len(latencies) / elapsed))
+    print('Failed invocations : {}'.format(failures))
+    for name, value in sorted(stats.get_counters().items()):
+        if name.endswith('_errors') or name == 'messages_shed':
+            print('{} : {}'.format(name, value))
+    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        print('{} latency : {:.1f} ms'.format(
+            name, percentile(latencies, fraction)))
+    print('max latency : {:.1f} ms'.format(latencies[-1]))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())